@@ -1,4 +1,7 @@
 import os
+import shutil
+import queue
+import threading
 import pydicom
 import numpy as np
 import cv2
@@ -6,6 +9,7 @@ from matplotlib import pyplot as plt
 import random
 import time
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from IPython.core.display import display, HTML
 
 # Determine if we are in a Jupyter notebook
@@ -55,121 +59,311 @@ def list_dicom_directories(root_dir):
                 
     return list(dicom_dirs)
 
-def load_scan(path):
-    slices = [pydicom.read_file(path + '/' + s) for s in os.listdir(path)]
+def _read_scan_headers(path):
+    # Read the files in parallel, deferring the pixel data until it is decoded
+    file_paths = [path + '/' + s for s in os.listdir(path)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        slices = list(executor.map(lambda file_path: pydicom.dcmread(file_path, defer_size='1 KB'), file_paths))
     slices.sort(key = lambda x: float(x.ImagePositionPatient[2]))
-    try:
-        slice_thickness = np.abs(slices[0].ImagePositionPatient[2] - slices[1].ImagePositionPatient[2])
-    except:
-        slice_thickness = np.abs(slices[0].SliceLocation - slices[1].SliceLocation)
 
-    for s in slices:
-        s.SliceThickness = slice_thickness
-        
-    return slices
+    # The datasets are saved again as the output files, so their headers are left as they were read
 
-def get_pixels_hu(slices):
-    image = np.stack([s.pixel_array for s in slices])
-    # Convert to int16 (from sometimes int16), 
+    # Keep the rescale parameters as arrays, as they are the only tags used by the processing
+    slope = np.array([s.RescaleSlope for s in slices], dtype=np.float64)
+    intercept = np.array([s.RescaleIntercept for s in slices], dtype=np.float64)
+
+    # Allocate an int16 volume for the pixels (from sometimes uint16), 
     # should be possible as values should always be low enough (<32k)
-    image = image.astype(np.int16)
+    pixels = np.empty((len(slices), slices[0].Rows, slices[0].Columns), dtype=np.int16)
+
+    return slices, pixels, slope, intercept
+
+def _decode_slice(slices, pixels, i):
+    ds = slices[i]
+    pixels[i] = ds.pixel_array
+
+    # Remember where the pixel data is in the original file, so it can be patched in place when saving
+    element = ds['PixelData']
+    if element.file_tell is not None and not element.is_undefined_length:
+        ds._pixel_data_location = (element.file_tell, len(element.value))
+
+    # Keep only the header of the slice, so the pixels are not stored twice
+    del ds.PixelData
+    return i
+
+def load_scan(path):
+    # Standalone loader, kept as public API
+    # drown_volume uses load_and_mask_scan instead, which overlaps decoding with masking
+    slices, pixels, slope, intercept = _read_scan_headers(path)
+
+    # Decode the slices in parallel straight into the volume
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(lambda i: _decode_slice(slices, pixels, i), range(len(slices))))
+        
+    return slices, pixels, slope, intercept
+
+def get_pixels_hu(pixels, slope, intercept):
+    # The stored pixel volume is converted in place when every slope is 1,
+    # otherwise a new volume is returned
+    image = pixels
 
     # Set outside-of-scan pixels to 0
     # The intercept is usually -1024, so air is approximately 0
     image[image == -2000] = 0
     
+    # Per-slice rescale parameters, shaped to broadcast over the whole volume
+    slope = slope.reshape(-1, 1, 1)
+    intercept = intercept.reshape(-1, 1, 1)
+
     # Convert to Hounsfield units (HU)
-    for slice_number in range(len(slices)):
-        
-        intercept = slices[slice_number].RescaleIntercept
-        slope = slices[slice_number].RescaleSlope
-        
-        if slope != 1:
-            image[slice_number] = slope * image[slice_number].astype(np.float64)
-            image[slice_number] = image[slice_number].astype(np.int16)
-            
-        image[slice_number] += np.int16(intercept)
+    if np.any(slope != 1):
+        # Truncate the scaled values before adding the intercept, as the per-slice loop used to
+        image = (image * slope).astype(np.int16)
+    image += intercept.astype(np.int16)
     
-    return np.array(image, dtype=np.int16)
+    return image
 
 def binarize_volume(volume, air_hu=AIR_THRESHOLD):
-    binary_volume = np.zeros_like(volume, dtype=np.uint8)
-    binary_volume[volume <= air_hu] = 1
+    # Standalone version of the binarization step, kept as public API
+    # drown_volume binarizes each slice inside mask_pipeline instead
+    # Booleans are stored as 0/1 bytes, so the comparison can be reinterpreted as uint8 in a single pass
+    binary_volume = (volume <= air_hu).view(np.uint8)
     return binary_volume
 
 def largest_connected_component(binary_image):
-    # Find all connected components and stats
-    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary_image, connectivity=8)
+    # Find all connected components and stats, with 16-bit labels to halve the memory traffic
+    # The areas are counted during the labelling itself, which is cheaper than a bincount over the labels
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary_image, connectivity=8, ltype=cv2.CV_16U)
 
     # Get the index of the largest component, ignoring the background
-    # The background is considered as a component by connectedComponentsWithStats and it is usually the first component
+    # The background is considered as a component by connectedComponentsWithStats and it is always the first component
     largest_component_index = np.argmax(stats[1:, cv2.CC_STAT_AREA]) + 1
 
     # Create an image to keep largest component only
-    largest_component_image = np.zeros(labels.shape, dtype=np.uint8)
-    largest_component_image[labels == largest_component_index] = 1
+    # Booleans are stored as 0/1 bytes, so the comparison can be reinterpreted as uint8 in a single pass
+    largest_component_image = (labels == largest_component_index).view(np.uint8)
 
     return largest_component_image
 
-def get_largest_component_volume(volume):
+def _process_slices(func, n_slices, executor=None):
+    # OpenCV releases the GIL, so independent slices can be processed by a pool of threads.
+    # OpenCV's own threading is disabled meanwhile to avoid oversubscribing the cores.
+    num_threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(func, range(n_slices)))
+        else:
+            list(executor.map(func, range(n_slices)))
+    finally:
+        cv2.setNumThreads(num_threads)
+
+def _map_slices(func, volume, dtype=np.uint8):
     # Initialize an empty array to hold the processed volume
-    processed_volume = np.empty_like(volume, dtype=np.uint8)
-    
-    # Iterate over each slice in the volume
-    for i in range(volume.shape[0]):
-        # Process the slice and store it in the processed volume
-        processed_volume[i] = largest_connected_component(volume[i])
-        
-    return processed_volume
+    out_volume = np.empty(volume.shape, dtype=dtype)
+
+    def process_slice(i):
+        out_volume[i] = func(volume[i])
+
+    _process_slices(process_slice, volume.shape[0])
+
+    return out_volume
+
+def get_largest_component_volume(volume):
+    # Standalone version of the connected component step, kept as public API
+    # drown_volume processes each slice inside mask_pipeline instead
+    # Process every slice in parallel and store it in the processed volume
+    return _map_slices(largest_connected_component, volume)
 
 
 
 def dilate_volume(volume, kernel_size=KERNEL_SIZE):
+    # Standalone version of the dilation step, kept as public API
+    # drown_volume dilates each slice inside mask_pipeline instead
     # Create the structuring element (kernel) for dilation
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     
-    # Initialize an empty array to hold the dilated volume
-    dilated_volume = np.empty_like(volume)
+    # Stack the slices on top of each other, separated by enough empty rows that the kernel
+    # cannot reach from one slice into the next, so the whole volume is dilated in a single call
+    n_slices, height, width = volume.shape
+    padding = kernel_size // 2
+    stacked_volume = np.zeros((n_slices, height + padding, width), dtype=np.uint8)
+    stacked_volume[:, :height] = volume
     
-    # Iterate over each slice in the volume
-    for i in range(volume.shape[0]):
-        # Dilate the slice and store it in the dilated volume
-        dilated_volume[i] = cv2.dilate(volume[i].astype(np.uint8), kernel)
+    # Dilate the stacked slices and drop the padding rows
+    dilated_volume = cv2.dilate(stacked_volume.reshape(-1, width), kernel)
+    dilated_volume = dilated_volume.reshape(n_slices, height + padding, width)[:, :height]
         
-    return dilated_volume
+    return dilated_volume.astype(volume.dtype)
+
+
+def _mask_slices(hu_volume, air_hu, kernel, processed_volume, dilated_volume, executor=None):
+    def process_slice(i):
+        # Binarize, keep the largest connected component and dilate it while the slice is still
+        # in cache, instead of materializing and traversing a full volume after each step
+        binary_image = (hu_volume[i] <= air_hu).view(np.uint8)
+        processed_volume[i] = largest_connected_component(binary_image)
+        cv2.dilate(processed_volume[i], kernel, dst=dilated_volume[i])
+
+    _process_slices(process_slice, hu_volume.shape[0], executor)
+
+def mask_pipeline(hu_volume, air_hu=AIR_THRESHOLD, kernel_size=KERNEL_SIZE):
+    # Create the structuring element (kernel) for dilation
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+
+    # Initialize empty arrays to hold the processed and dilated volumes
+    processed_volume = np.empty(hu_volume.shape, dtype=np.uint8)
+    dilated_volume = np.empty(hu_volume.shape, dtype=np.uint8)
+
+    _mask_slices(hu_volume, air_hu, kernel, processed_volume, dilated_volume)
+
+    return processed_volume, dilated_volume
+
+
+def load_and_mask_scan(path, air_hu=AIR_THRESHOLD, kernel_size=KERNEL_SIZE, batch_size=32):
+    slices, pixels_hu, slope, intercept = _read_scan_headers(path)
+    n_slices = len(slices)
+
+    # Create the structuring element (kernel) for dilation
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+
+    # Initialize empty arrays to hold the processed and dilated volumes
+    processed_volume = np.empty(pixels_hu.shape, dtype=np.uint8)
+    dilated_volume = np.empty(pixels_hu.shape, dtype=np.uint8)
+
+    # Decoding and masking run at the same time, so the cores are split between their pools
+    cpu_count = os.cpu_count() or 1
+    n_decode_workers = max(cpu_count // 2, 1)
+    n_mask_workers = max(cpu_count - n_decode_workers, 1)
+
+    # Decode the slices in a background thread, which reports them in order as they become available
+    decoded = queue.Queue()
+
+    def decode_slices():
+        try:
+            with ThreadPoolExecutor(max_workers=n_decode_workers) as executor:
+                for i in executor.map(lambda i: _decode_slice(slices, pixels_hu, i), range(n_slices)):
+                    decoded.put(i)
+        except BaseException as e:
+            decoded.put(e)
+
+    decoder = threading.Thread(target=decode_slices, daemon=True)
+    decoder.start()
+
+    # Meanwhile, convert and mask the slices in batches as soon as they are decoded
+    with ThreadPoolExecutor(max_workers=n_mask_workers) as executor:
+        for start in range(0, n_slices, batch_size):
+            stop = min(start + batch_size, n_slices)
+            for _ in range(start, stop):
+                i = decoded.get()
+                if isinstance(i, BaseException):
+                    raise i
+
+            # The batch is converted in place, unless a slope other than 1 makes a new array
+            batch_hu = get_pixels_hu(pixels_hu[start:stop], slope[start:stop], intercept[start:stop])
+            if np.any(slope[start:stop] != 1):
+                pixels_hu[start:stop] = batch_hu
+
+            _mask_slices(pixels_hu[start:stop], air_hu, kernel,
+                         processed_volume[start:stop], dilated_volume[start:stop], executor)
+
+    decoder.join()
+
+    return slices, pixels_hu, slope, intercept, processed_volume, dilated_volume
 
 
 def apply_mask_and_get_values(image_volume, mask_volume):
-    # Apply the mask by multiplying the image volume with the mask volume
-    masked_volume = image_volume * mask_volume
-    
-    # Get all unique values in the masked volume, excluding zero
-    unique_values = np.unique(masked_volume)
-    unique_values = unique_values[unique_values > FACE_MIN_VALUE]
-    unique_values = unique_values[unique_values < FACE_MAX_VALUE]
+    # OpenCV needs the mask as a uint8 volume of 0s and 1s, so convert masks of any other type
+    if mask_volume.dtype != np.uint8:
+        mask_volume = (mask_volume != 0).view(np.uint8)
 
-    # Convert numpy array to a list
-    unique_values_list = unique_values.tolist()
-    
-    return unique_values_list
+    # Find the voxels within the face range in a single pass (255 inside the range, 0 outside)
+    width = image_volume.shape[-1]
+    in_range = cv2.inRange(image_volume.reshape(-1, width), FACE_MIN_VALUE + 1, FACE_MAX_VALUE - 1)
 
+    # Keep only the ones under the mask, which holds 0s and 1s, so the result can be reinterpreted as booleans
+    in_range = cv2.bitwise_and(in_range, mask_volume.reshape(-1, width))
 
-def apply_random_values_optimized(pixels_hu, dilated_volume, unique_values_list):
-    # Initialize new volume as a copy of the original volume
-    new_volume = np.copy(pixels_hu)
+    # Select those voxels with a single gather, instead of multiplying the whole volume by the mask
+    values = image_volume[in_range.reshape(image_volume.shape).view(bool)]
 
-    # Generate random indices
-    random_indices = np.random.choice(len(unique_values_list), size=np.sum(dilated_volume))
+    # If no voxel under the mask is within the face range, fall back to 0 HU, which the previous
+    # multiply-based version always included, so there is always a value to sample from
+    if values.size == 0:
+        values = np.zeros(1, dtype=image_volume.dtype)
 
-    # Select random values from the unique_values_list
-    random_values = np.array(unique_values_list)[random_indices]
+    return values
+
+
+def apply_random_values_optimized(pixels_hu, dilated_volume, values, copy=True):
+    # Initialize new volume as a copy of the original volume, or modify the original one in place
+    new_volume = np.copy(pixels_hu) if copy else pixels_hu
+
+    # A uint8 dilated volume holds 0s and 1s, so it can be reinterpreted as a boolean mask without a copy
+    if dilated_volume.dtype == np.uint8:
+        mask = dilated_volume.view(bool)
+    else:
+        mask = dilated_volume == 1
+
+    # Convert the values (a list or an array) to the type of the volume
+    values = np.asarray(values, dtype=new_volume.dtype)
+    if values.size == 1:
+        # A single replacement value (air or an integer) needs no sampling at all
+        random_values = values[0]
+    else:
+        # Sample random indices, with replacement, only for the masked locations
+        # Indices into short lists of values fit in a byte, which quarters the memory of the indices
+        rng = np.random.default_rng()
+        index_dtype = np.uint8 if values.size <= 256 else np.int32
+        random_indices = rng.integers(0, values.size, size=np.count_nonzero(mask), dtype=index_dtype)
+
+        # Look up the random values from the sampled indices
+        random_values = values[random_indices]
 
     # Apply the random values to the locations where dilated_volume equals 1
-    new_volume[dilated_volume == 1] = random_values
+    new_volume[mask] = random_values
 
     return new_volume
 
-def save_new_dicom_files(new_volume, original_dir, out_path, app="_d"):
+def _write_pixel_data_in_place(ds, pixel_data, new_file_name):
+    # Only possible when the original file is stored natively and the pixel data keeps its size
+    # Deflated files are not compressed in the pixel data sense, but their offsets point into the
+    # inflated stream rather than the file on disk, so they are not patched in place either
+    location = getattr(ds, '_pixel_data_location', None)
+    native_syntaxes = (pydicom.uid.ImplicitVRLittleEndian, pydicom.uid.ExplicitVRLittleEndian)
+    if location is None or not isinstance(ds.filename, str) or ds.file_meta.TransferSyntaxUID not in native_syntaxes:
+        return False
+
+    offset, length = location
+    if length != len(pixel_data):
+        return False
+
+    # Copy the original file and overwrite its pixel data, instead of re-serializing every tag
+    shutil.copyfile(ds.filename, new_file_name)
+    with open(new_file_name, 'rb+') as f:
+        f.seek(offset)
+        f.write(pixel_data)
+
+    return True
+
+def _save_dicom_slice(ds, stored_slice, new_file_name):
+    # Slices along the first axis of the volume are contiguous, so their bytes can be used without a copy
+    pixel_data = memoryview(stored_slice).cast('B')
+
+    # Patch the pixel data of a copy of the original file when possible
+    if _write_pixel_data_in_place(ds, pixel_data, new_file_name):
+        return
+
+    # Otherwise update the header with the uncompressed data from the new slice
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds.add_new('PixelData', 'OW', pixel_data.tobytes())
+
+    # Save the new DICOM file
+    ds.save_as(new_file_name)
+
+def save_new_dicom_files(new_volume, slices, slope, intercept, original_dir, out_path, app="_d"):
     # Create a new directory path by appending "_d" to the original directory
     if out_path is None:
         new_dir = original_dir + app
@@ -180,40 +374,33 @@ def save_new_dicom_files(new_volume, original_dir, out_path, app="_d"):
     if not os.path.exists(new_dir):
         os.makedirs(new_dir)
 
-    # List all DICOM files in the original directory
-    dicom_files = [os.path.join(original_dir, f) for f in os.listdir(original_dir) if f.endswith('.dcm')]
-
-    # Sort the dicom_files list by SliceLocation
-    dicom_files.sort(key=lambda x: pydicom.dcmread(x).SliceLocation)
-
-    # Loop over each slice of the new volume
-    for i in range(new_volume.shape[0]):
-        # Get the corresponding original DICOM file
-        dicom_file = dicom_files[i]
-
-        # Read the file
-        ds = pydicom.dcmread(dicom_file)
-        ds.decompress()
-
-        # Revert the slope and intercept operation on the slice
-        new_slice = (new_volume[i] - ds.RescaleIntercept) / ds.RescaleSlope
-
-        # Update the pixel data with the data from the new slice
-        ds.PixelData = new_slice.astype(np.int16).tobytes()
+    # Revert the slope and intercept operation on the whole volume at once,
+    # using the per-slice rescale parameters returned by load_scan
+    slope = slope.reshape(-1, 1, 1)
+    intercept = intercept.reshape(-1, 1, 1)
+    stored_volume = np.empty(new_volume.shape, dtype=np.int16)
+    if np.all(slope == 1):
+        # The common case for CT only needs an int16 subtraction
+        np.subtract(new_volume, intercept.astype(np.int16), out=stored_volume)
+    else:
+        np.divide(new_volume - intercept, slope, out=stored_volume, casting='unsafe')
 
-        # Generate new file name 
-        new_file_name = os.path.join(new_dir, f"new_image_{i}.dcm")
+    # Generate new file names
+    new_file_names = [os.path.join(new_dir, f"new_image_{i}.dcm") for i in range(len(slices))]
 
-        # Save the new DICOM file
-        ds.save_as(new_file_name)
+    # Save each slice of the new volume in parallel, reusing the datasets already
+    # parsed (and sorted) by load_scan instead of reading every file again.
+    # The number of workers is capped, as the disk saturates well before the CPUs do
+    with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 8)) as executor:
+        list(executor.map(_save_dicom_slice, slices, stored_volume, new_file_names))
 
 
 
 def drown_volume(in_path, out_path='deid_ct', replacer='face'):
     """
     Processes DICOM files from the provided directory by binarizing, getting the largest connected component, 
-    dilating and applying mask. Then applies random values to the dilated volume based on a unique values list 
-    obtained from the masked volume (or air value). The results are saved as new DICOM files in a specified directory.
+    dilating and applying mask. Then applies random values to the dilated volume sampled from the values 
+    found in the masked volume (or air value). The results are saved as new DICOM files in a specified directory.
     
     Parameters:
     in_path (str): The path to the directory containing the input DICOM files.
@@ -233,49 +420,36 @@ def drown_volume(in_path, out_path='deid_ct', replacer='face'):
     
     for _d in tqdm(dirs, desc="List of studies"):
 
-        with tqdm(total=8, desc="Processing DICOM Files", leave=False) as pbar:
-            # Load the DICOM files
-            slices = load_scan(_d)
-            pbar.update()
-
-            # Get the pixel values and convert them to Hounsfield Units (HU)
-            pixels_hu = get_pixels_hu(slices)
+        with tqdm(total=4, desc="Processing DICOM Files", leave=False) as pbar:
+            # Load the DICOM files, convert them to Hounsfield Units (HU), binarize the HU volume,
+            # get its largest connected component and dilate it, overlapping decoding with the rest
+            slices, pixels_hu, slope, intercept, processed_volume, dilated_volume = load_and_mask_scan(_d)
             pbar.update()
 
-            # Apply the binarization function on the HU volume
-            binarized_volume = binarize_volume(pixels_hu)
-            pbar.update()
-
-            # Get the largest connected component from the binarized volume
-            processed_volume = get_largest_component_volume(binarized_volume)
-            pbar.update()
-
-            # Dilate the processed volume
-            dilated_volume = dilate_volume(processed_volume)
-            pbar.update()
+            # The dilated volume contains the processed one, so the rim around it is their XOR
             if replacer == 'face':
-                # Apply the mask to the original volume and get unique values list
-                unique_values_list = apply_mask_and_get_values(pixels_hu, dilated_volume - processed_volume)
+                # Apply the mask to the original volume and get the rim values
+                values = apply_mask_and_get_values(pixels_hu, np.bitwise_xor(dilated_volume, processed_volume))
             elif replacer == 'air':
-                unique_values_list = [0]
+                values = [0]
             else:
                 try:
                     replacer = int(replacer)
-                    unique_values_list = [replacer]
+                    values = [replacer]
                 except:
                     print('replacer must be either air, face, or an integer number in Hounsfield units, but ' + str(replacer) + ' was provided.')
                     print('replacing with face')
-                    unique_values_list = apply_mask_and_get_values(pixels_hu, dilated_volume - processed_volume)
+                    values = apply_mask_and_get_values(pixels_hu, np.bitwise_xor(dilated_volume, processed_volume))
 
             pbar.update()
 
-            # Apply random values to the dilated volume based on the unique values list
-            new_volume = apply_random_values_optimized(pixels_hu, dilated_volume, unique_values_list)
+            # Apply random values to the dilated volume based on the values
+            new_volume = apply_random_values_optimized(pixels_hu, dilated_volume, values, copy=False)
             pbar.update()
 
             # Save the new DICOM files
             out_path_n = out_path + "/" + get_first_directory(_d)
-            save_new_dicom_files(new_volume, _d, out_path_n)
+            save_new_dicom_files(new_volume, slices, slope, intercept, _d, out_path_n)
             pbar.update()
 
         elapsed_time = time.time() - start_time